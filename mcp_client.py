@@ -1,37 +1,130 @@
 import asyncio
-import json
+import hashlib
+import io
 import os
-from typing import Optional
-from contextlib import AsyncExitStack
+from collections import Counter, OrderedDict
+from typing import Callable, List, Optional
+from contextlib import AsyncExitStack, asynccontextmanager
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.types import CallToolResult, TextContent
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+import orjson
+from openai import AsyncAzureOpenAI
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
 
 load_dotenv()  # load environment variables from .env
 
+# Tools that only read the loaded dataset, so their results can be reused until it changes
+CACHEABLE_TOOLS = {
+    "get_column_names",
+    "describe_column",
+    "get_value_counts",
+    "compute_mean",
+    "compute_standard_deviation",
+}
+
+class LRUCache:
+    """Mapping that keeps at most `maxsize` entries, evicting the least recently used"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+class MCPPool:
+    """Sessions with `size` copies of an MCP server, each running in its own subprocess
+
+    Used as an async context manager, which starts the servers and shuts them down on exit.
+    """
+
+    def __init__(self, server_params: StdioServerParameters, size: int = 1):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.server_params = server_params
+        self.size = size
+        self.sessions: List[ClientSession] = []
+        # Sessions that are not checked out by `acquire`
+        self.idle: asyncio.Queue = asyncio.Queue()
+        self.exit_stack = AsyncExitStack()
+
+    async def __aenter__(self):
+        try:
+            # The transports are entered one by one so they are closed by the task that opened them,
+            # but the servers start up concurrently while the handshakes are awaited together
+            for _ in range(self.size):
+                stdio, write = await self.exit_stack.enter_async_context(stdio_client(self.server_params))
+                session = await self.exit_stack.enter_async_context(ClientSession(stdio, write))
+                self.sessions.append(session)
+                self.idle.put_nowait(session)
+            await asyncio.gather(*(session.initialize() for session in self.sessions))
+        except BaseException:
+            await self.exit_stack.aclose()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.exit_stack.aclose()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Check out an idle session for the duration of the block, waiting until one is free
+
+        Each server holds a single dataset, so a session is never handed to two holders at once.
+        """
+        session = await self.idle.get()
+        try:
+            yield session
+        finally:
+            self.idle.put_nowait(session)
+
 class MCPClient:
-    def __init__(self):
+    def __init__(self, max_concurrent_requests: int = 8, cache_size: int = 1024):
         # Initialize session and client objects
+        self.pool: Optional[MCPPool] = None
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
+        # Cap on in-flight chat completions, to stay within the deployment's rate limit
+        self.request_semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+        # Caches for completions and read-only tool calls; `cache_size=0` disables them
+        self.completion_cache = LRUCache(cache_size)
+        self.tool_cache = LRUCache(cache_size)
+        # Bumped around every call that may modify the dataset loaded on a session's server
+        self._data_versions = Counter()
         
         endpoint = os.getenv("ENDPOINT_URL")
         subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
 
         self.deployment = os.getenv("DEPLOYMENT_NAME")
-        self.client = AzureOpenAI(
+        self.client = AsyncAzureOpenAI(
             azure_endpoint=endpoint,
             api_key=subscription_key,
             api_version="2024-05-01-preview"
         )
 
-    async def connect_to_server(self, server_script_path: str):
+    async def connect_to_server(self, server_script_path: str, pool_size: int = 1):
         """Connect to an MCP server
         
         Args:
             server_script_path: Path to the server script (.py or .js)
+            pool_size: Number of server processes to start, i.e. how many queries can run at once
         """
         is_python = server_script_path.endswith('.py')
         is_js = server_script_path.endswith('.js')
@@ -45,27 +138,13 @@ class MCPClient:
             env=None
         )
         
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
-        
-        await self.session.initialize()
+        self.pool = await self.exit_stack.enter_async_context(MCPPool(server_params, pool_size))
+        self.session = self.pool.sessions[0]
         
         # List available tools
         response = await self.session.list_tools()
         self.tools = response.tools
-        print(f"Connected! Discovered {len(self.tools)} tools: {[tool.name for tool in self.tools]}")
-
-    async def process_query(self, query: str) -> str:
-        """Process a query using Claude and available tools"""
-        messages = [
-            {
-                "role": "user",
-                "content": query
-            }
-        ]
-        
-        tools = [
+        self._tools_schema = [
             {
                 "type": "function",
                 "function": {
@@ -76,87 +155,232 @@ class MCPClient:
             }
             for tool in self.tools
         ]
+        self._tools_hash = hashlib.blake2b(orjson.dumps(self._tools_schema, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        # Argument validators compiled from the input schemas, to reject malformed calls without a round trip
+        self._validators = {}
+        if fastjsonschema is not None:
+            self._validators = {tool.name: fastjsonschema.compile(tool.inputSchema) for tool in self.tools}
+        print(f"Connected! Discovered {len(self.tools)} tools: {[tool.name for tool in self.tools]}")
 
-        response = self.client.chat.completions.create(
-            model=self.deployment,
-            messages=messages,
-            max_tokens=1000,
-            temperature=0.7,
-            top_p=0.95,
-            tools=tools,
-        )
+    async def _complete(self, messages: list, on_tool_call: Callable[[dict], None]):
+        """Stream a chat completion, waiting for a free concurrency slot
+
+        Returns the finish reason and the assistant message. `on_tool_call` is called with each
+        tool call as soon as its arguments have been streamed, so it can start while the model
+        is still generating. Responses are cached, so repeating an identical request returns the
+        earlier completion.
+        """
+        params = {
+            "model": self.deployment,
+            "max_tokens": 1000,
+            "temperature": 0.7,
+            "top_p": 0.95,
+        }
+        key = hashlib.blake2b(
+            orjson.dumps([params, messages, self._tools_hash], option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+        cached = self.completion_cache.get(key)
+        if cached is not None:
+            finish_reason, message = cached
+            if finish_reason == 'tool_calls':
+                for tool_call in message.get("tool_calls", []):
+                    on_tool_call(tool_call)
+            return cached
+
+        content = []
+        tool_calls = []
+        finish_reason = None
+        async with self.request_semaphore:
+            stream = await self.client.chat.completions.create(
+                messages=messages,
+                tools=self._tools_schema,
+                stream=True,
+                **params,
+            )
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices: # e.g. Azure's content filter results
+                        continue
+                    choice = chunk.choices[0]
+                    if choice.delta.content:
+                        content.append(choice.delta.content)
+                    for delta in choice.delta.tool_calls or []:
+                        if delta.index == len(tool_calls):
+                            # a new tool call starts, so the previous one is complete
+                            if tool_calls:
+                                on_tool_call(tool_calls[-1])
+                            tool_calls.append({"id": delta.id, "type": "function", "function": {"name": "", "arguments": ""}})
+                        if delta.function is None:
+                            continue
+                        function = tool_calls[delta.index]["function"]
+                        if delta.function.name:
+                            function["name"] += delta.function.name
+                        if delta.function.arguments:
+                            function["arguments"] += delta.function.arguments
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+        # a content filter can end the response with no tool call deltas
+        if finish_reason == 'tool_calls' and tool_calls:
+            on_tool_call(tool_calls[-1])
+
+        message = {"role": "assistant", "content": "".join(content) or None}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        # truncated or filtered responses are not cached, so an identical request gets a fresh sample
+        if finish_reason == 'stop' or (finish_reason == 'tool_calls' and tool_calls):
+            self.completion_cache.put(key, (finish_reason, message))
+        return finish_reason, message
+
+    async def _call_tool(self, session: ClientSession, tool_name: str, tool_args: dict):
+        """Call a tool on the server of `session`, reusing earlier results of read-only tools"""
+        validate = self._validators.get(tool_name)
+        if validate is not None:
+            try:
+                validate(tool_args)
+            except fastjsonschema.JsonSchemaException as e:
+                return CallToolResult(
+                    content=[TextContent(type="text", text=f"Invalid arguments for tool {tool_name}: {e.message}")],
+                    isError=True
+                )
+
+        if tool_name not in CACHEABLE_TOOLS:
+            # the tool may modify the loaded dataset, so results cached before or during it are stale
+            self._data_versions[session] += 1
+            try:
+                return await session.call_tool(tool_name, tool_args)
+            finally:
+                self._data_versions[session] += 1
+
+        key = (session, self._data_versions[session], tool_name, orjson.dumps(tool_args, option=orjson.OPT_SORT_KEYS))
+        result = self.tool_cache.get(key)
+        if result is None:
+            result = await session.call_tool(tool_name, tool_args)
+            if not result.isError:
+                self.tool_cache.put(key, result)
+        return result
+
+    async def process_query(self, query: str) -> str:
+        """Process a query using Claude and available tools
+
+        The query checks out a server of its own from the pool, since later tool calls depend on the
+        data loaded by earlier ones.
+        """
+        async with self.pool.acquire() as session:
+            return await self._process_query(session, query)
+
+    async def _process_query(self, session: ClientSession, query: str) -> str:
+        messages = [
+            {
+                "role": "user",
+                "content": query
+            }
+        ]
 
         # Process response and handle tool calls
-        final_text = []
+        final_text = io.StringIO()
         while True:
-            content = response.choices[0]
-            if content.finish_reason == 'stop':
-                final_text.append(content.message.content)
+            # Tool calls of this turn start as soon as they are streamed, and run concurrently
+            tool_calls = []
+            def start_tool_call(tool_call: dict):
+                tool_args = orjson.loads(tool_call["function"]["arguments"]) # convert from str to dict
+                task = asyncio.create_task(self._call_tool(session, tool_call["function"]["name"], tool_args))
+                tool_calls.append((tool_call, tool_args, task))
+
+            try:
+                finish_reason, message = await self._complete(messages, start_tool_call)
+            except BaseException:
+                for _, _, task in tool_calls:
+                    task.cancel()
+                raise
+
+            if finish_reason == 'stop':
+                final_text.write(message["content"])
                 break
-            elif content.finish_reason == 'tool_calls':
-                for tool_call in content.message.tool_calls:
-                    tool_name = tool_call.function.name
-                    tool_args = json.loads(tool_call.function.arguments) # convert from str to dict
-                
-                    # Execute tool call
-                    result = await self.session.call_tool(tool_name, tool_args)
-                    final_text.append(f"[Calling tool {tool_name} with args {tool_args}]")
-                    final_text.append(f"[Tool response: {result.content}]")
+            elif finish_reason == 'tool_calls' and tool_calls:
+                results = await asyncio.gather(*[task for _, _, task in tool_calls])
+                messages.append(message)
 
-                    messages.append({
-                        "role": "assistant", 
-                        "content": f"[Calling tool {tool_name} with args {tool_args}]"
-                    })
+                for (tool_call, tool_args, _), result in zip(tool_calls, results):
+                    result_text = self._tool_result_text(result)
+                    final_text.write(f"[Calling tool {tool_call['function']['name']} with args {tool_args}]\n")
+                    final_text.write(f"[Tool response: {result_text}]\n")
 
                     messages.append({
-                        "role": "user", 
-                        "content": result.content
+                        "role": "tool",
+                        "tool_call_id": tool_call["id"],
+                        "content": result_text
                     })
-
-                    # get model's response to tool call
-                    response = self.client.chat.completions.create(
-                        model=self.deployment,
-                        messages=messages,
-                        max_tokens=1000,
-                        temperature=0.7,
-                        top_p=0.95,
-                        tools=tools
-                    )
             else:
-                print("Finish reason:", content.finish_reason)
+                print("Finish reason:", finish_reason)
+                for _, _, task in tool_calls:
+                    task.cancel()
+                break
+
+        return final_text.getvalue()
+
+    async def process_queries(self, queries: List[str]) -> List[str]:
+        """Process several queries concurrently
+
+        Each query checks out a server of the pool for its whole run, so queries never see each
+        other's dataset. With more queries than servers, the rest wait for a server to be free.
+        """
+        return await asyncio.gather(*(self.process_query(query) for query in queries))
 
-        return "\n".join(final_text)
+    @staticmethod
+    def _tool_result_text(result) -> str:
+        """Flatten the text blocks of a tool result into a single string"""
+        return "\n".join(block.text for block in result.content if block.type == "text")
 
     async def chat_loop(self):
-        """Run an interactive chat loop"""
+        """Run an interactive chat loop
+
+        Queries are answered in the background, so new queries can be entered
+        while earlier ones are still being processed. Each query waits for a
+        server of its own, as in `process_queries`.
+        """
         print("\nMCP Client Started!")
         print("Type your queries or 'quit' to exit.")
-        
+
+        pending = set()
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                query = (await asyncio.to_thread(input, "\nQuery: ")).strip()
                 
                 if query.lower() == 'quit':
                     break
-                    
-                response = await self.process_query(query)
-                print("\n" + response)
-                    
+
+                task = asyncio.create_task(self._answer_query(query))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            except EOFError:
+                break
             except Exception as e:
                 print(f"\nError: {str(e)}")
+
+        await asyncio.gather(*pending)
+
+    async def _answer_query(self, query: str):
+        """Process a single query from the chat loop and print the response"""
+        try:
+            response = await self.process_query(query)
+            print("\n" + response)
+        except Exception as e:
+            print(f"\nError: {str(e)}")
     
     async def cleanup(self):
         """Clean up resources"""
         await self.exit_stack.aclose()
+        await self.client.close()
 
 async def main():
     if len(sys.argv) < 2:
-        print("Usage: python client.py <path_to_server_script>")
+        print("Usage: python client.py <path_to_server_script> [pool_size]")
         sys.exit(1)
         
+    pool_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1
     client = MCPClient()
     try:
-        await client.connect_to_server(sys.argv[1])
+        await client.connect_to_server(sys.argv[1], pool_size)
         await client.chat_loop()
     finally:
         await client.cleanup()
@@ -1,13 +1,219 @@
+import functools
 import logging
+import operator
 from typing import List
 from mcp.server.fastmcp import FastMCP
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 mcp = FastMCP("DataAgent")
 logger = logging.getLogger("mcp")
 logger.setLevel(logging.INFO)
 
-df = None
+# The loaded dataset is kept as read, together with the positions of the rows that are still
+# selected after `filter` and `remove_outliers`. Columns are only gathered when a tool reads them.
+_base_df = None
+_active_idx = None
+# incremented whenever the selected rows change, invalidating cached column statistics
+_df_version = 0
+
+# strings read as missing values, the same as the `pd.read_csv` defaults
+_NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+# numexpr evaluates in blocks across its thread pool, which only pays off for long columns and several threads
+_NUMEXPR_MIN_SIZE = 1 << 16
+
+# comparison applied by each `by` option of the `filter` tool
+_FILTER_OPS = {
+    "equal": operator.eq,
+    "less": operator.lt,
+    "less/equal": operator.le,
+    "greater": operator.gt,
+    "greater/equal": operator.ge,
+}
+
+# the same comparisons as Arrow kernels, used on numeric columns
+_ARROW_FILTER_OPS = {
+    "equal": pc.equal,
+    "less": pc.less,
+    "less/equal": pc.less_equal,
+    "greater": pc.greater,
+    "greater/equal": pc.greater_equal,
+}
+
+def _column_names(header : List[str]) -> List[str]:
+    """Names columns like `pd.read_csv`: empty names become "Unnamed: i" and repeated names get a ".k" suffix.
+
+    Suffixes that are already names in the header are skipped, and unnamed columns are renamed last.
+    """
+    names = [name or f"Unnamed: {i}" for i, name in enumerate(header)]
+    unnamed = [i for i, name in enumerate(header) if not name]
+    named = [i for i, name in enumerate(header) if name]
+    counts = {}
+    for i in named + unnamed:
+        name = candidate = names[i]
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[name] = count + 1
+            candidate = f"{name}.{count}"
+            count = count + 1 if candidate in names else counts.get(candidate, 0)
+        names[i] = candidate
+        counts[candidate] = count + 1
+    return names
+
+def _read_csv(file_name : str) -> pd.DataFrame:
+    """Reads `file_name` with Arrow's multithreaded CSV parser into Arrow-backed columns.
+
+    Columns are named and typed as `pd.read_csv` would by default: dates and times stay text and empty columns are float.
+    Files Arrow cannot parse, e.g. with rows that have missing or extra fields, are read by `pd.read_csv` instead.
+    """
+    convert_options = pacsv.ConvertOptions(null_values=_NA_VALUES, strings_can_be_null=True)
+    try:
+        # types inferred from the first block are enough to find the date and time columns
+        with pacsv.open_csv(file_name, convert_options=convert_options) as reader:
+            inferred = reader.schema
+        temporal = {field.name for field in inferred if pa.types.is_temporal(field.type)}
+        convert_options.column_types = dict.fromkeys(temporal, pa.string())
+        table = pacsv.read_csv(file_name, convert_options=convert_options)
+        for i, field in enumerate(inferred):
+            if field.name in temporal and not (pa.types.is_temporal(field.type) or pa.types.is_null(field.type)):
+                # a repeated name shares the text type of a date column with the same name
+                table = table.set_column(i, field.name, table.column(i).cast(field.type))
+    except pa.ArrowInvalid:
+        return pd.read_csv(file_name)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    table = table.rename_columns(_column_names(table.column_names))
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def _column(column_name : str) -> pd.Series:
+    """Returns the selected rows of `column_name`."""
+    column = _base_df[column_name]
+    if _active_idx.size == len(column):
+        return column
+    return column.take(_active_idx)
+
+def _numeric_values(column_name : str, dtype=None):
+    """Returns the non-missing values of `column_name` as a NumPy array, or `None` if the column is not numeric (booleans count as numeric)."""
+    column_dtype = _base_df[column_name].dtype
+    if not (is_numeric_dtype(column_dtype) or is_bool_dtype(column_dtype)):
+        return None
+    return _column(column_name).dropna().to_numpy(dtype=dtype)
+
+# Column statistics, cached per dataset version. Each tool that changes the selected rows bumps
+# `_df_version`, so repeated calls on an unchanged dataset are answered without rescanning the column.
+
+@functools.lru_cache(maxsize=16)
+def _float_values(version : int, column_name : str):
+    """`_numeric_values` as float64, gathered once per version and shared by the statistics below.
+
+    Only holds columns of the current version: `_bump_version` clears it.
+    """
+    values = _numeric_values(column_name, dtype=np.float64)
+    if values is not None:
+        values.flags.writeable = False
+    return values
+
+@functools.lru_cache(maxsize=256)
+def _describe(version : int, column_name : str) -> dict:
+    values = None if is_bool_dtype(_base_df[column_name]) else _float_values(version, column_name)
+    if values is None:
+        return _column(column_name).describe().to_dict()
+    if values.size == 0:
+        return {'count': 0.0, **dict.fromkeys(['mean', 'std', 'min', '25%', '50%', '75%', 'max'], np.nan)}
+    q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+    return {
+        'count': float(values.size),
+        'mean': float(values.mean()),
+        'std': float(values.std(ddof=1)) if values.size > 1 else np.nan,
+        'min': float(values.min()),
+        '25%': float(q1),
+        '50%': float(median),
+        '75%': float(q3),
+        'max': float(values.max())
+    }
+
+@functools.lru_cache(maxsize=256)
+def _value_counts(version : int, column_name : str) -> dict:
+    values = None if is_bool_dtype(_base_df[column_name]) else _numeric_values(column_name)
+    if values is None:
+        return _column(column_name).value_counts().to_dict()
+    # most frequent first, ties in order of first appearance
+    if numba is not None and values.dtype.kind in 'iu':
+        # integer columns are mostly low-cardinality codes, where a single hashing pass beats sorting
+        uniques, counts = _count_values(values)
+        order = np.argsort(-counts, kind='stable')
+    else:
+        uniques, first_index, counts = np.unique(values, return_index=True, return_counts=True)
+        order = np.lexsort((first_index, -counts))
+    return dict(zip(uniques[order].tolist(), counts[order].tolist()))
+
+@functools.lru_cache(maxsize=256)
+def _mean(version : int, column_name : str) -> float:
+    values = _float_values(version, column_name)
+    if values is None:
+        return _column(column_name).mean()
+    return float(values.mean()) if values.size else np.nan
+
+@functools.lru_cache(maxsize=256)
+def _std(version : int, column_name : str) -> float:
+    values = _float_values(version, column_name)
+    if values is None:
+        return _column(column_name).std()
+    return float(values.std(ddof=1)) if values.size > 1 else np.nan
+
+def _bump_version():
+    """Marks the selected rows as changed. Cached values of earlier versions can never be hit again, so they are dropped."""
+    global _df_version
+    _df_version += 1
+    for cached in (_float_values, _describe, _value_counts, _mean, _std):
+        cached.cache_clear()
+
+if numba is not None:
+    @numba.njit(cache=True, parallel=True, boundscheck=False)
+    def _iqr_mask(values, lower, upper, out):
+        """Sets `out[i]` to whether `values[i]` lies within [`lower`, `upper`], in a single pass without temporaries."""
+        for i in numba.prange(values.size):
+            out[i] = (values[i] >= lower) & (values[i] <= upper)
+
+    @numba.njit(cache=True)
+    def _count_values(values):
+        """Returns the distinct `values` in order of first appearance, and how often each occurs."""
+        uniques = np.empty_like(values)
+        counts = np.zeros(values.size, dtype=np.int64)
+        if values.size == 0:
+            return uniques, counts
+        index = {values[0]: 0}
+        uniques[0] = values[0]
+        n = 1
+        for value in values:
+            if value in index:
+                i = index[value]
+            else:
+                i = n
+                index[value] = i
+                uniques[i] = value
+                n += 1
+            counts[i] += 1
+        return uniques[:n], counts[:n]
 
 # simple tool for testing
 # @mcp.tool()
@@ -18,36 +224,38 @@ df = None
 @mcp.tool()
 def load_data(file_name : str) -> dict:
     """Load data from `file_name`. Must be executed before all other tools."""
-    global df
+    global _base_df, _active_idx
     if not file_name.endswith('.csv'):
         file_name += '.csv'
     if not file_name.startswith("examples/DA-Agent/data/da-dev-tables/"):
         file_name = "examples/DA-Agent/data/da-dev-tables/" + file_name
-    df = pd.read_csv(file_name)
+    _base_df = _read_csv(file_name)
+    _active_idx = np.arange(len(_base_df))
+    _bump_version()
     return {
         'success': True,
         'information': {
-            'data size': df.shape[0]
+            'data size': _active_idx.size
         }
     }
 
 @mcp.tool()
 def get_column_names() -> List[str]:
     """Returns all column names of dataset. Must execute `load_data` before using this tool."""
-    assert df is not None, "Must execute `load_data` first."
-    return df.columns.tolist()
+    assert _base_df is not None, "Must execute `load_data` first."
+    return _base_df.columns.tolist()
 
 @mcp.tool()
 def describe_column(column_name : str) -> dict:
     """Uses the `describe` function from the `pandas` library to describe the `column_name`. Must execute `load_data` before using this tool."""
-    assert df is not None, "Must execute `load_data` first."
-    return df[column_name].describe().to_dict()
+    assert _base_df is not None, "Must execute `load_data` first."
+    return dict(_describe(_df_version, column_name))
 
 @mcp.tool()
 def get_value_counts(column_name : str) -> dict:
     """Uses the `value_counts` function from the `pandas` library to get the value counts from `column_name`. Must execute `load_data` before using this tool."""
-    assert df is not None, "Must execute `load_data` first."
-    return df[column_name].value_counts().to_dict()
+    assert _base_df is not None, "Must execute `load_data` first."
+    return dict(_value_counts(_df_version, column_name))
 
 @mcp.tool()
 def filter(column_name : str, value : float, by : str) -> dict:
@@ -66,61 +274,76 @@ def filter(column_name : str, value : float, by : str) -> dict:
         "greater": keep only values strictly greater than `value`.
         "greater/equal": keep only values greater than or equal to `value`.
     """
-    global df
-    assert df is not None, "Must execute `load_data` first."
-    if by == "equal":
-        df = df[df[column_name] == value]
-    elif by == "less":
-        df = df[df[column_name] < value]
-    elif by == "less/equal":
-        df = df[df[column_name] <= value]
-    elif by == "greater":
-        df = df[df[column_name] > value]
-    elif by == "greater/equal":
-        df = df[df[column_name] >= value]
-    else:
+    global _active_idx
+    assert _base_df is not None, "Must execute `load_data` first."
+    op = _FILTER_OPS.get(by)
+    if op is None:
         return {
             "success": False,
             "information": {
                 "error message": f"Unrecognized value for `by`: \"{by}\"."
             }
         }
+    column = _base_df[column_name]
+    arrow_type = column.dtype.pyarrow_dtype if isinstance(column.dtype, pd.ArrowDtype) else None
+    if arrow_type is not None and (pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type)):
+        # compare the Arrow data directly; missing values compare as null and are not kept
+        values = column.array.__arrow_array__()
+        if _active_idx.size != len(column):
+            values = pc.take(values, _active_idx)
+        keep = _ARROW_FILTER_OPS[by](values, value).fill_null(False).to_numpy(zero_copy_only=False)
+    else:
+        keep = op(_column(column_name).to_numpy(na_value=np.nan), value)
+    _active_idx = _active_idx[keep]
+    _bump_version()
     return {
         'success': True,
         'information': {
-            'data size': df.shape[0]
+            'data size': _active_idx.size
         }
     }
 
 @mcp.tool()
 def remove_outliers(column_name : str) -> dict:
     "Removes outliers with interquartile range method for provided `column_name`. Must execute `load_data` before using this tool."
-    global df
-    assert df is not None, "Must execute `load_data` first."
-    q1 = df[column_name].quantile(0.25)
-    q3 = df[column_name].quantile(0.75)
+    global _active_idx
+    assert _base_df is not None, "Must execute `load_data` first."
+    values = _column(column_name).to_numpy(dtype=np.float64, na_value=np.nan)
+    q1, q3 = np.nanquantile(values, [0.25, 0.75]) if values.size else (np.nan, np.nan)
     iqr = q3 - q1
     lower = q1 - 1.5 * iqr
     upper = q3 + 1.5 * iqr
-    df = df[(lower <= df[column_name]) & (df[column_name] <= upper)]
+    # missing values compare false, so they are dropped like in the pandas comparison
+    if numba is not None:
+        mask = np.empty(values.size, dtype=np.bool_)
+        _iqr_mask(values, lower, upper, mask)
+    elif numexpr is not None and numexpr.nthreads > 1 and values.size >= _NUMEXPR_MIN_SIZE:
+        mask = numexpr.evaluate(
+            "(values >= lower) & (values <= upper)",
+            local_dict={'values': values, 'lower': lower, 'upper': upper}
+        )
+    else:
+        mask = (values >= lower) & (values <= upper)
+    _active_idx = _active_idx[mask]
+    _bump_version()
     return {
         'success': True,
         'information': {
-            'data size': df.shape[0]
+            'data size': _active_idx.size
         }
     }
 
 @mcp.tool()
 def compute_mean(column_name : str) -> float:
     """Computes mean of provided `column_name`. Must execute `load_data` before using this tool."""
-    assert df is not None, "Must execute `load_data` first."
-    return df[column_name].mean()
+    assert _base_df is not None, "Must execute `load_data` first."
+    return _mean(_df_version, column_name)
 
 @mcp.tool()
 def compute_standard_deviation(column_name : str) -> float:
     """Computes standard deviation of provided `column_name`. Must execute `load_data` before using this tool."""
-    assert df is not None, "Must execute `load_data` first."
-    return df[column_name].std()
+    assert _base_df is not None, "Must execute `load_data` first."
+    return _std(_df_version, column_name)
 
 
 if __name__ == "__main__":